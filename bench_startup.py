@@ -0,0 +1,93 @@
+"""
+Startup benchmark for scraper.py. Times `import scraper` and
+`scraper.py --help` in fresh interpreters and checks that neither pulls
+in the heavy dependencies, which should only load on the code paths that
+use them.
+
+Exits non-zero if a heavy module is imported or the median time goes
+over budget, so it can gate changes to the import graph.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("requests", "ftfy", "mysql.connector", "sqlite3",
+                 "concurrent.futures")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import scraper
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def time_import():
+    out = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=HERE, universal_newlines=True).split("\n")
+
+    return float(out[0]), [m for m in out[1].split(",") if m]
+
+
+def time_help():
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "scraper.py", "--help"], cwd=HERE,
+                          stdout=subprocess.DEVNULL)
+
+    return time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark scraper.py startup.")
+    arg_parser.add_argument(
+        "-n", "--runs",
+        dest="runs",
+        type=int,
+        default=10,
+        help="number of fresh interpreters to time (default: 10)")
+    arg_parser.add_argument(
+        "--budget",
+        dest="budget",
+        type=float,
+        default=150,
+        help="maximum median time for `scraper.py --help`, in ms (default: 150)")
+
+    args = arg_parser.parse_args()
+
+    import_times = []
+    heavy = set()
+    for _ in range(args.runs):
+        elapsed, loaded = time_import()
+        import_times.append(elapsed)
+        heavy.update(loaded)
+
+    help_times = [time_help() for _ in range(args.runs)]
+
+    import_ms = statistics.median(import_times) * 1000
+    help_ms = statistics.median(help_times) * 1000
+
+    print("import scraper:      {:.1f} ms (median of {})".format(import_ms, args.runs))
+    print("scraper.py --help:   {:.1f} ms (median of {})".format(help_ms, args.runs))
+
+    failed = False
+
+    if heavy:
+        print("FAIL: importing scraper loaded {}".format(", ".join(sorted(heavy))))
+        failed = True
+
+    if help_ms > args.budget:
+        print("FAIL: --help took longer than {} ms".format(args.budget))
+        failed = True
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,9 @@
 import logging
 import functools
+import io
 import os
 import sys
+import traceback
 
 def set_srcfile():
     if hasattr(sys, 'frozen'): #support for py2exe
@@ -16,16 +18,16 @@ def set_srcfile():
 
 # http://stackoverflow.com/questions/4957858/
 # Ugly, ugly hack. I'm  sorry.
-# We have no self here because it seems not to be passed to
-# the monkeypatched method.
-def find_caller_monkeypatch(self, stack_info=False):
+# We have no self here because it isn't passed to the monkeypatched
+# method. Python 3.8+ also passes stacklevel, which we ignore.
+def find_caller_monkeypatch(stack_info=False, stacklevel=1):
     # pylint: disable=invalid-name, protected-access
     """
     Find the stack frame of the caller so that we can note the source
     file name, line number and function name.
     """
     f = logging.currentframe().f_back
-    rv = "(unknown file)", 0, "(unknown function)"
+    rv = "(unknown file)", 0, "(unknown function)", None
 
     while hasattr(f, "f_code"):
         co = f.f_code
@@ -84,7 +86,13 @@ class EasyLogger(object):
 
 LOGGING_FMT = "<%(filename)s:%(lineno)s(%(levelname)s) - %(funcName)s()> "\
                         "%(message)s"
-logging.basicConfig(level=logging.DEBUG, format=LOGGING_FMT)
+
+def configure(level=logging.DEBUG):
+    """
+    Set up the root handler. Called by entry points rather than at import
+    time, so that importing this module stays cheap.
+    """
+    logging.basicConfig(level=level, format=LOGGING_FMT)
 
 # LOG = logging.getLogger(__name__)
 
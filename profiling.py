@@ -0,0 +1,238 @@
+"""
+Opt-in resource profiling for tour scrapes. A Profiler records wall and
+CPU time, Python heap (tracemalloc) and peak RSS per pipeline stage,
+download throughput per getter, and a cProfile dump for the whole run.
+
+CPU time includes child processes (the post-processing pool) once they
+have exited. The kernel only keeps lifetime peaks for RSS, so reports
+carry both the process-lifetime peaks (*_max_rss_mb) and how much this
+run raised them (*_rss_growth_mb); a worker's later tours only show
+growth past what earlier tours already reached. Comparisons use growth.
+
+Reports are JSON, so runs can be compared with:
+
+    python profiling.py OLD_REPORT NEW_REPORT [--tolerance 0.2]
+
+which exits non-zero if anything got worse by more than the tolerance.
+"""
+import argparse
+import contextlib
+import json
+import sys
+import time
+
+MB = 1024 * 1024
+
+# report fields where bigger is worse
+RUN_COSTS = ("wall_seconds", "cpu_seconds", "max_rss_growth_mb",
+             "child_rss_growth_mb")
+STAGE_COSTS = ("wall_seconds", "cpu_seconds", "python_peak_mb",
+               "max_rss_growth_mb", "child_rss_growth_mb")
+
+
+def _usage():
+    '''
+    Get CPU seconds used so far by this process and its finished children,
+    and the lifetime peak RSS of this process and of its largest child.
+    '''
+    import resource
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # kilobytes on Linux, bytes on macOS
+    rss_unit = MB if sys.platform == "darwin" else 1024
+
+    return {"cpu_seconds": own.ru_utime + own.ru_stime,
+            "child_cpu_seconds": children.ru_utime + children.ru_stime,
+            "max_rss_mb": own.ru_maxrss / rss_unit,
+            "child_max_rss_mb": children.ru_maxrss / rss_unit}
+
+
+def _usage_between(before, after):
+    return {"cpu_seconds": after["cpu_seconds"] - before["cpu_seconds"] +
+                           after["child_cpu_seconds"] -
+                           before["child_cpu_seconds"],
+            "child_cpu_seconds": after["child_cpu_seconds"] -
+                                 before["child_cpu_seconds"],
+            "max_rss_mb": after["max_rss_mb"],
+            "max_rss_growth_mb": after["max_rss_mb"] - before["max_rss_mb"],
+            "child_max_rss_mb": after["child_max_rss_mb"],
+            "child_rss_growth_mb": after["child_max_rss_mb"] -
+                                   before["child_max_rss_mb"]}
+
+
+class Profiler:
+    TOP_ALLOCATIONS = 10
+
+    def __init__(self):
+        import cProfile
+        import tracemalloc
+
+        self._tracemalloc = tracemalloc
+        self._cprofile = cProfile.Profile()
+        self._start_wall = None
+        self._end_wall = None
+        self._start_usage = None
+        self._end_usage = None
+        self.stages = {}
+        self.transfers = {}
+
+    def start(self):
+        self._tracemalloc.start()
+        self._start_wall = time.perf_counter()
+        self._start_usage = _usage()
+        self._cprofile.enable()
+
+    def stop(self):
+        self._cprofile.disable()
+        self._tracemalloc.stop()
+        self._end_wall = time.perf_counter()
+        self._end_usage = _usage()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Measure the block as one stage of the run.
+        '''
+        self._tracemalloc.reset_peak()
+        before, _ = self._tracemalloc.get_traced_memory()
+        start_wall = time.perf_counter()
+        start_usage = _usage()
+
+        yield
+
+        wall = time.perf_counter() - start_wall
+        usage = _usage_between(start_usage, _usage())
+        current, peak = self._tracemalloc.get_traced_memory()
+        top = self._tracemalloc.take_snapshot().statistics("lineno")
+
+        self.stages[name] = dict(
+            usage,
+            wall_seconds=wall,
+            python_peak_mb=peak / MB,
+            python_growth_mb=(current - before) / MB,
+            top_allocations=[str(stat) for stat in
+                             top[:self.TOP_ALLOCATIONS]])
+
+    def record_transfer(self, getter, num_bytes, seconds):
+        totals = self.transfers.setdefault(getter, {"files": 0, "bytes": 0,
+                                                    "seconds": 0.0})
+        totals["files"] += 1
+        totals["bytes"] += num_bytes
+        totals["seconds"] += seconds
+
+    def report(self):
+        transfers = {}
+        for getter, totals in self.transfers.items():
+            transfers[getter] = dict(totals)
+            transfers[getter]["mb_per_second"] = \
+                totals["bytes"] / MB / totals["seconds"] \
+                if totals["seconds"] else None
+
+        end_wall = self._end_wall or time.perf_counter()
+        end_usage = self._end_usage or _usage()
+
+        return dict(_usage_between(self._start_usage, end_usage),
+                    wall_seconds=end_wall - self._start_wall,
+                    stages=self.stages,
+                    transfers=transfers)
+
+    def write(self, report_path, pstats_path):
+        self._cprofile.dump_stats(pstats_path)
+
+        with open(report_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NoOpProfiler:
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+    def record_transfer(self, getter, num_bytes, seconds):
+        pass
+
+    def write(self, report_path, pstats_path):
+        pass
+
+
+def _worse(old, new, tolerance, bigger_is_worse=True):
+    if old is None or new is None or old <= 0:
+        return False
+
+    change = (new - old) / old
+    return change > tolerance if bigger_is_worse else -change > tolerance
+
+
+def compare(old, new, tolerance=0.2):
+    '''
+    Get a list of human-readable regressions from report old to report
+    new: costs that grew, or throughputs that fell, by more than
+    tolerance (as a fraction).
+    '''
+    regressions = []
+
+    def check(label, old_value, new_value, bigger_is_worse=True):
+        if _worse(old_value, new_value, tolerance, bigger_is_worse):
+            regressions.append("{}: {:.3f} -> {:.3f}".format(
+                label, old_value, new_value))
+
+    for field in RUN_COSTS:
+        check(field, old.get(field), new.get(field))
+
+    for stage, old_stage in old.get("stages", {}).items():
+        new_stage = new.get("stages", {}).get(stage)
+        if new_stage is None:
+            continue
+        for field in STAGE_COSTS:
+            check("{} {}".format(stage, field), old_stage.get(field),
+                  new_stage.get(field))
+
+    for getter, old_transfer in old.get("transfers", {}).items():
+        new_transfer = new.get("transfers", {}).get(getter)
+        if new_transfer is None:
+            continue
+        check("{} mb_per_second".format(getter),
+              old_transfer.get("mb_per_second"),
+              new_transfer.get("mb_per_second"),
+              bigger_is_worse=False)
+
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare two resource reports.")
+    arg_parser.add_argument("old", help="report from the baseline run")
+    arg_parser.add_argument("new", help="report from the run to check")
+    arg_parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        default=0.2,
+        help="fractional change to allow before flagging (default: 0.2)")
+
+    args = arg_parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = compare(old, new, args.tolerance)
+
+    for regression in regressions:
+        print("REGRESSION", regression)
+
+    if not regressions:
+        print("No regressions beyond {:.0%}.".format(args.tolerance))
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,31 @@
 #pylint: disable=line-too-long, invalid-name, too-few-public-methods
 import subprocess
 import collections
-import requests
 import re
 import logging
 import math
-import ftfy
 import argparse
 import os
 import gzip
 import shutil
 import glob
 import traceback
+import hashlib
+import mmap
+import json
+import pickle
+import threading
+import time
+import contextlib
+import types
+import zlib
+import tempfile
+import socket
 
-from mysql import connector
 from sys import argv, stdout
 
 import easylogger
+import profiling
 import config
 
 # LOG = easylogger.LOG
@@ -40,6 +49,9 @@ class SCPConnectionError(SCPError):
 class BadArgumentsError(Exception):
     pass
 
+class SnapshotError(Exception):
+    pass
+
 class MultiKeyDict(collections.UserDict):
     """
     Dictionary to simulate 'case 10, 20, 30: ...'-style switch
@@ -48,14 +60,320 @@ class MultiKeyDict(collections.UserDict):
     def __getitem__(self, key):
         for my_key in self.data:
             if key in my_key:
-                return self.data[key]
+                return self.data[my_key]
 
         raise KeyError
 
 Note = collections.namedtuple("Note", ["text", "date", "first_name",
                                        "last_name"])
 
+class LocalSlots:
+    '''
+    Request slots for hosts, handed out within this process only.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_slots = {}
+
+    def reserve(self, host, interval):
+        '''
+        Book the next free slot for host and hold the following one back
+        for interval seconds. Returns how long to wait for the slot.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slots.get(host, 0))
+            self._next_slots[host] = slot + interval
+
+        return slot - now
+
+class SharedSlots:
+    '''
+    Request slots for hosts, booked in a SQLite file so that every process
+    using the same file (e.g. all the queue workers) shares one rate per
+    host. Uses wall-clock time, so nodes need roughly synced clocks.
+    '''
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, path):
+        import sqlite3
+
+        self._cx = sqlite3.connect(path, timeout=self.LOCK_TIMEOUT,
+                                   isolation_level=None)
+        self._cx.execute("CREATE TABLE IF NOT EXISTS throttle_slots "
+                         "(host TEXT PRIMARY KEY, next_slot REAL)")
+
+    def reserve(self, host, interval):
+        self._cx.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = self._cx.execute("SELECT next_slot FROM throttle_slots "
+                                   "WHERE host = ?", (host,)).fetchone()
+            slot = max(now, row[0] if row else 0)
+            self._cx.execute("INSERT OR REPLACE INTO throttle_slots "
+                             "VALUES (?, ?)", (host, slot + interval))
+            self._cx.execute("COMMIT")
+        except Exception:
+            self._cx.execute("ROLLBACK")
+            raise
+
+        return slot - now
+
+class Throttle:
+    '''
+    AIMD rate limiter for one shared backend host. Wrap each request in
+    `with throttle.track() as call:` and set call.failed for responses
+    that mean "back off".
+
+    Our requests to each host are sequential, so what adapts is the request
+    rate, not a concurrency limit. The rate starts at max_rate. It's cut by
+    `backoff` on an error, or when short-term latency rises past
+    `latency_tolerance` times the long-term average, at most once per
+    `cooldown` seconds. Each fast response adds `recovery` requests/sec
+    back, up to max_rate. With no max_rate the throttle only keeps stats
+    and never slows anything down.
+
+    Calls tracked with `track(timed=False)` (e.g. file transfers, whose
+    time depends on the file rather than the host) only adapt on errors.
+
+    Slots come from `slots`. Pass a SharedSlots to make max_rate cap all
+    processes sharing its file together, rather than each one.
+    '''
+    FAST_SMOOTHING = 0.2
+    SLOW_SMOOTHING = 0.01
+    # ignore latency swings smaller than this, however large in proportion
+    MIN_LATENCY_RISE = 0.05
+
+    def __init__(self, name, max_rate=None, slots=None, min_rate=0.1,
+                 recovery=0.5, latency_tolerance=2.0, backoff=0.5,
+                 cooldown=1.0):
+        self.name = name
+        self._max_rate = max_rate
+        self._rate = max_rate
+        self._slots = slots or LocalSlots()
+        self._min_rate = min_rate
+        self._recovery = recovery
+        self._latency_tolerance = latency_tolerance
+        self._backoff = backoff
+        self._cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._last_backoff = None
+        self._requests = 0
+        self._errors = 0
+        self._backoffs = 0
+        self._short_latency = None
+        self._long_latency = None
+
+    def _acquire(self):
+        with self._lock:
+            rate = self._rate
+
+        if rate:
+            wait = self._slots.reserve(self.name, 1.0 / rate)
+            if wait > 0:
+                time.sleep(wait)
+
+    def _release(self, latency, failed):
+        '''
+        Account for one finished call; latency is None for untimed calls.
+        '''
+        with self._lock:
+            self._requests += 1
+
+            if failed:
+                self._errors += 1
+
+            slow = False
+            if latency is not None:
+                if self._short_latency is None:
+                    self._short_latency = self._long_latency = latency
+                else:
+                    self._short_latency += self.FAST_SMOOTHING * \
+                                           (latency - self._short_latency)
+                    self._long_latency += self.SLOW_SMOOTHING * \
+                                          (latency - self._long_latency)
+
+                slow = self._short_latency > \
+                       self._long_latency * self._latency_tolerance and \
+                       self._short_latency - self._long_latency > \
+                       self.MIN_LATENCY_RISE
+
+            if self._max_rate is None:
+                return
+
+            if failed or slow:
+                now = time.monotonic()
+                if self._last_backoff is None or \
+                   now - self._last_backoff >= self._cooldown:
+                    self._last_backoff = now
+                    self._backoffs += 1
+                    self._rate = max(self._min_rate,
+                                     self._rate * self._backoff)
+            else:
+                self._rate = min(self._max_rate, self._rate + self._recovery)
+
+    @contextlib.contextmanager
+    def track(self, timed=True):
+        self._acquire()
+        call = types.SimpleNamespace(failed=False)
+        start = time.monotonic()
+
+        def latency():
+            return time.monotonic() - start if timed else None
+
+        try:
+            yield call
+        except Exception:
+            self._release(latency(), True)
+            raise
+
+        self._release(latency(), call.failed)
+
+    def stats(self):
+        with self._lock:
+            return {"name": self.name,
+                    "rate": self._rate,
+                    "max_rate": self._max_rate,
+                    "shared": isinstance(self._slots, SharedSlots),
+                    "requests": self._requests,
+                    "errors": self._errors,
+                    "backoffs": self._backoffs,
+                    "latency": self._short_latency}
+
+class NoOpThrottle:
+    def __init__(self, name=None):
+        self.name = name
+
+    @contextlib.contextmanager
+    def track(self, timed=True):
+        yield types.SimpleNamespace(failed=False)
+
+    def stats(self):
+        return {"name": self.name}
+
+class ArchiveIndex:
+    '''
+    On-disk index of med_arc file names to full paths, so that archive
+    paths resolve without globbing the (huge, NFS-mounted) directory once
+    per image. The directory is only rescanned when its mtime differs from
+    the one recorded in the index. If the directory isn't mounted here
+    (e.g. SCP mode, with an index built on the archive host), the stored
+    index is used as-is.
+    '''
+    ARC_DIR = "/data/cmap/med_arc"
+    # where an archive's ID prefix may end: after a separator or a run of
+    # digits. Names are looked up by everything past one of these.
+    SUFFIX_START = re.compile(r"(?<=[_\-.])|(?<=\d)(?=\D)")
+
+    def __init__(self, index_path, arc_dir=ARC_DIR):
+        self.arc_dir = arc_dir
+        self._index_path = index_path
+        self._mtime = None
+        self._entries = {}
+        self._by_suffix = {}
+
+        try:
+            with open(index_path) as f:
+                stored = json.load(f)
+            if stored["arc_dir"] == arc_dir:
+                self._mtime = stored["mtime"]
+                self._entries = stored["entries"]
+        except (OSError, ValueError, KeyError):
+            LOG.info("No usable archive index at {}, building one.".format(
+                index_path))
+
+        self._index_suffixes()
+        self.refresh()
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.arc_dir).st_mtime
+        except OSError:
+            LOG.debug("Archive dir", self.arc_dir, "isn't available here, "
+                      "using the stored index")
+            return
+
+        if mtime == self._mtime:
+            return
+
+        with os.scandir(self.arc_dir) as entries:
+            new_entries = {entry.name: entry.path for entry in entries}
+
+        LOG.info("Archive index refreshed: {} added, {} removed".format(
+            len(new_entries.keys() - self._entries.keys()),
+            len(self._entries.keys() - new_entries.keys())))
+
+        self._entries = new_entries
+        self._mtime = mtime
+        self._index_suffixes()
+        self.save()
+
+    def save(self):
+        tmp_path = "{}.tmp".format(self._index_path)
+        with open(tmp_path, "w") as f:
+            json.dump({"arc_dir": self.arc_dir,
+                       "mtime": self._mtime,
+                       "entries": self._entries}, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _index_suffixes(self):
+        '''
+        Map every name an entry could be looked up by to its path. Where
+        several entries share a suffix, the last path in sort order wins,
+        as it would with the sorted glob this replaces.
+        '''
+        by_suffix = {}
+
+        for entry, path in self._entries.items():
+            starts = {0}
+            starts.update(match.start() for match in
+                          self.SUFFIX_START.finditer(entry))
+
+            for start in starts:
+                suffix = entry[start:]
+                if suffix and path > by_suffix.get(suffix, ""):
+                    by_suffix[suffix] = path
+
+        self._by_suffix = by_suffix
+
+    def _lookup(self, name):
+        return self._by_suffix.get(name)
+
+    def resolve(self, name):
+        '''
+        Get the full path of the archive file named name, possibly behind an
+        ID prefix, or None if there isn't one.
+        '''
+        path = self._lookup(name)
+
+        if path is None:
+            # the directory may have changed since we last looked
+            self.refresh()
+            path = self._lookup(name)
+
+        return path
+
 class AbstractGetter:
+    COPY_BUFSIZE = 1024 * 1024
+
+    def __init__(self, arc_index=None, throttle=None):
+        self._arc_index = arc_index
+        self._throttle = throttle or NoOpThrottle()
+
+    def _resolve(self, remote):
+        '''
+        Turn an archive glob into a concrete path via the archive index, if
+        we have one. Anything the index can't answer is passed through.
+        '''
+        if self._arc_index is None or \
+           os.path.dirname(remote) != self._arc_index.arc_dir:
+            return remote
+
+        return self._arc_index.resolve(
+            os.path.basename(remote).lstrip("*")) or remote
+
     @staticmethod
     def _build_unzipped_name(name):
         file_name = os.path.basename(name)
@@ -69,6 +387,19 @@ class AbstractGetter:
         self._get(remote, local)
         return gzip.open(local), self._build_unzipped_name(local)
 
+    def get_unzipped(self, remote, local):
+        '''
+        Fetch remote to local and decompress it into the same directory.
+        Returns the path to the decompressed file.
+        '''
+        gzipped, unzipped_name = self.get(remote, local)
+        unzipped_path = os.path.join(os.path.dirname(local), unzipped_name)
+
+        with gzipped, open(unzipped_path, "wb") as new_file:
+            shutil.copyfileobj(gzipped, new_file, self.COPY_BUFSIZE)
+
+        return unzipped_path
+
 
 class SCPGetter(AbstractGetter):
     """
@@ -80,9 +411,16 @@ class SCPGetter(AbstractGetter):
 
     get(remote : string, local : string) -> void / BadFileTransferError
     """
+    # scp exit codes, as relayed from ssh/sftp
+    ERRORS = MultiKeyDict({
+        (1, 4, 5, 8, 65, 67, 71, 72, 73, 74, 75, 76, 79): SCPConnectionError,
+        (2, 3, 7, 10, 70): RemoteFileError,
+        (6,): LocalFileError
+    })
 
     def __init__(self, password=config.SCP_PASSWORD, user=config.SCP_USERNAME,
-                 scp_fmt=config.SCP_COMMAND):
+                 scp_fmt=config.SCP_COMMAND, arc_index=None, throttle=None):
+        super().__init__(arc_index, throttle)
 
         self._password = password
         self._user = user
@@ -91,55 +429,384 @@ class SCPGetter(AbstractGetter):
     def _build_query(self, remote, local):
         return self._scp_fmt.format(password=self._password,
                                     user=self._user,
-                                    remote=remote,
+                                    remote=self._resolve(remote),
                                     local=local).split(" ")
 
     def _get(self, remote, local):
-        subprocess.check_call(self._build_query(remote, local))
-
-        # except subprocess.CalledProcessError as err:
-        #     resp = MultiKeyDict({
-        #         (1, 4, 5, 8, 65, 67, 71, 72, 73, 74, 75, 76, 79): \
-        #         SCPConnectionError,
-        #         (2, 3, 7, 10, 70): RemoteFileError,
-        #         (6,): LocalFileError
-        #     })
-
-        #     try:
-        #         raise resp[err.returncode]("Error code: {}".format(
-        #             err.returncode))
-        #     except KeyError:
-        #         raise err
+        # transfer time is down to file size, so only back off on errors
+        try:
+            with self._throttle.track(timed=False):
+                subprocess.check_call(self._build_query(remote, local))
+        except subprocess.CalledProcessError as err:
+            try:
+                error = self.ERRORS[err.returncode]
+            except KeyError:
+                raise err
+
+            raise error("Error code: {}".format(err.returncode)) from err
 
 class LocalGetter(AbstractGetter):
+    '''
+    Reads straight out of the archive mount. Compressed archives are
+    decompressed from a read-only mmap of the source without staging a
+    copy; uncompressed sources are reflinked, hardlinked or copied
+    in-kernel, depending on link_mode.
+    '''
+    LINK_MODES = ("copy", "reflink", "hardlink")
+    # from linux/fs.h
+    FICLONE = 0x40049409
+
+    def __init__(self, link_mode="copy", arc_index=None):
+        super().__init__(arc_index)
+
+        if link_mode not in self.LINK_MODES:
+            raise BadArgumentsError("Unknown link mode: {}".format(link_mode))
+
+        self._link_mode = link_mode
+
+    def _find_source(self, remote):
+        remote = self._resolve(remote)
+
+        if "*" not in remote and os.path.exists(remote):
+            return remote
+
+        sources = glob.glob(remote)
+
+        if not sources:
+            raise IOError("No archive file matches {}".format(remote))
+
+        # the old copy-everything loop left the last match in place
+        return sources[-1]
+
     def _get(self, remote, local):
-        got_something = False
-        for f in glob.glob(remote):
-            got_something = True
-            shutil.copy(f, local)
+        shutil.copy(self._find_source(remote), local)
+
+    def get_unzipped(self, remote, local):
+        source = self._find_source(remote)
+        local_dir = os.path.dirname(local)
+
+        if source.endswith(".gz"):
+            unzipped_path = os.path.join(local_dir,
+                                         self._build_unzipped_name(local))
+            self._decompress_mapped(source, unzipped_path)
+        else:
+            unzipped_path = os.path.join(local_dir, os.path.basename(local))
+            self._link_or_copy(source, unzipped_path)
+
+        return unzipped_path
+
+    def _decompress_mapped(self, source, dest):
+        if os.path.getsize(source) == 0:
+            raise IOError("Archive file {} is empty".format(source))
+
+        with open(source, "rb") as src, \
+             mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+            with gzip.GzipFile(fileobj=mapped) as gzipped, \
+                 open(dest, "wb") as new_file:
+                shutil.copyfileobj(gzipped, new_file, self.COPY_BUFSIZE)
+
+    def _link_or_copy(self, source, dest):
+        try:
+            # links refuse to replace an existing file
+            os.remove(dest)
+        except FileNotFoundError:
+            pass
+
+        try:
+            if self._link_mode == "hardlink":
+                os.link(source, dest)
+                return
+            elif self._link_mode == "reflink":
+                self._reflink(source, dest)
+                return
+        except OSError as err:
+            LOG.debug("Couldn't {} {}, copying instead: {}".format(
+                self._link_mode, source, err))
+
+        self._copy_in_kernel(source, dest)
+
+    def _reflink(self, source, dest):
+        import fcntl
+
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(dest)
+                raise
+
+    @staticmethod
+    def _copy_in_kernel(source, dest):
+        if hasattr(os, "copy_file_range"):
+            try:
+                with open(source, "rb") as src, open(dest, "wb") as dst:
+                    remaining = os.fstat(src.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(),
+                                                    remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                return
+            except OSError as err:
+                LOG.debug("copy_file_range failed, falling back:", err)
+
+        # uses sendfile where available
+        shutil.copyfile(source, dest)
+
+def _file_sha256(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def _derivative_paths(path, formats, thumbnail_sizes):
+    base_path = os.path.splitext(path)[0]
+    # never the source's own name (e.g. jpg to jpg), which may be
+    # hardlinked to the archive
+    paths = {fmt: "{}-web.{}".format(base_path, fmt) for fmt in formats}
+
+    for size in thumbnail_sizes:
+        paths["thumb-{}".format(size)] = "{}-thumb-{}.jpg".format(base_path,
+                                                                  size)
+
+    return paths
+
+def _up_to_date(path, derivatives):
+    try:
+        source_mtime = os.stat(path).st_mtime
+        return all(os.stat(out_path).st_mtime >= source_mtime
+                   for out_path in derivatives.values())
+    except FileNotFoundError:
+        return False
+
+def _post_process_image(path, formats, thumbnail_sizes):
+    '''
+    Checksum a downloaded image and build its web-format and thumbnail
+    derivatives. Runs in a worker process, so it only takes and returns
+    plain values. Conversion is skipped if PIL isn't installed, or if the
+    derivatives are already newer than the image (e.g. it was kept from an
+    earlier run).
+    '''
+    checksum = _file_sha256(path)
+    derivatives = _derivative_paths(path, formats, thumbnail_sizes)
+
+    if _up_to_date(path, derivatives):
+        return checksum, derivatives
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return checksum, {}
+
+    with Image.open(path) as image:
+        rgb_image = image.convert("RGB")
+
+        for fmt in formats:
+            rgb_image.save(derivatives[fmt])
+
+        for size in thumbnail_sizes:
+            thumbnail = rgb_image.copy()
+            thumbnail.thumbnail((size, size))
+            thumbnail.save(derivatives["thumb-{}".format(size)])
+
+    return checksum, derivatives
+
+class PostProcessor:
+    '''
+    Runs checksums, format conversion and thumbnailing for downloaded
+    images in a process pool, while the files are still in the page
+    cache. Results are recorded on each Media once finish() is called.
+    The pool is only started once there's something to submit.
+    '''
+    def __init__(self, formats=("jpg",), thumbnail_sizes=(256,), workers=None):
+        self._formats = tuple(formats)
+        self._thumbnail_sizes = tuple(thumbnail_sizes)
+        self._workers = workers
+        self._pool = None
+        self._pending = []
+
+    def submit(self, media_item):
+        if media_item.local_path is None:
+            return
+
+        if self._pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            # max_workers=None means one per core
+            self._pool = ProcessPoolExecutor(max_workers=self._workers)
+
+        try:
+            future = self._pool.submit(_post_process_image,
+                                       media_item.local_path,
+                                       self._formats,
+                                       self._thumbnail_sizes)
+        # e.g. BrokenProcessPool, if a worker died
+        except Exception as err: # pylint: disable=broad-except
+            LOG.error("Couldn't queue post-processing for",
+                      media_item.local_path, ":", err)
+            return
+
+        self._pending.append((media_item, future))
+
+    def finish(self):
+        '''
+        Wait for everything submitted so far and record the results.
+        '''
+        try:
+            for media_item, future in self._pending:
+                try:
+                    media_item.checksum, media_item.derivatives = \
+                        future.result()
+                # one bad image (e.g. PIL's DecompressionBombError) or a dead
+                # worker shouldn't lose the rest of the run
+                except Exception as err: # pylint: disable=broad-except
+                    LOG.error("Post-processing failed for",
+                              media_item.local_path, ":", repr(err))
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Shut the pool down, dropping anything that hasn't started yet.
+        Safe to call more than once.
+        '''
+        self._pending = []
 
-        if not got_something:
-            raise IOError()
-        # return gzip.open(local)
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
 
 class AbstractDownloader:
     '''Wrapper around one of SCP, Local and NoOp to manage download
     behavior
     '''
 
-    def __init__(self, getter=None):
+    def __init__(self, getter=None, post_processor=None):
         self._getter = getter
+        self._post_processor = post_processor
 
     def get(self, remote, section_id, page_id):
         raise NotImplementedError
 
+    def post_process(self, media_item):
+        if self._post_processor is not None:
+            self._post_processor.submit(media_item)
+
+    def finish(self):
+        if self._post_processor is not None:
+            self._post_processor.finish()
+
+    def close(self):
+        '''
+        Release anything held by the downloader, whether or not finish()
+        was reached.
+        '''
+        if self._post_processor is not None:
+            self._post_processor.close()
+
 class NoOpDownloader(AbstractDownloader):
     def get(self, remote, section_id, page_id):
         return None
 
+class DownloadIndex:
+    '''
+    Size and SHA-256 of every file a RealDownloader has written, keyed by
+    local path and tagged with the archive path it came from, so that
+    files already on disk can be verified instead of being transferred
+    again. Changes are written out every SAVE_EVERY records and on save().
+    '''
+    SAVE_EVERY = 100
+
+    def __init__(self, path):
+        self._path = path
+        self._unsaved = 0
+
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+        # drop anything written in an older layout; it'll be re-verified
+        self._entries = {local_path: entry for local_path, entry
+                         in self._entries.items()
+                         if isinstance(entry, dict) and "remote" in entry}
+
+        self._paths_by_remote = collections.defaultdict(list)
+        for local_path, entry in self._entries.items():
+            self._paths_by_remote[entry["remote"]].append(local_path)
+
+    def _verified(self, local_path):
+        entry = self._entries[local_path]
+
+        try:
+            if os.path.getsize(local_path) != entry["size"]:
+                return False
+        except OSError:
+            return False
+
+        return _file_sha256(local_path) == entry["sha256"]
+
+    def is_verified(self, remote, local_path):
+        '''
+        Check that local_path holds an intact copy of remote.
+        '''
+        entry = self._entries.get(local_path)
+        return entry is not None and entry["remote"] == remote and \
+               self._verified(local_path)
+
+    def verified_copy(self, remote):
+        '''
+        Get any local path holding an intact copy of remote, else None.
+        '''
+        for local_path in self._paths_by_remote.get(remote, []):
+            if self._entries.get(local_path, {}).get("remote") == remote and \
+               self._verified(local_path):
+                return local_path
+
+        return None
+
+    def record(self, remote, local_path, size, sha256):
+        self._entries[local_path] = {"remote": remote, "size": size,
+                                     "sha256": sha256}
+        self._paths_by_remote[remote].append(local_path)
+
+        self._unsaved += 1
+        if self._unsaved >= self.SAVE_EVERY:
+            self.save()
+
+    def record_copy(self, remote, source, local_path):
+        entry = self._entries[source]
+        self.record(remote, local_path, entry["size"], entry["sha256"])
+
+    def save(self):
+        if not self._unsaved:
+            return
+
+        tmp_path = "{}.tmp".format(self._path)
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self._path)
+        self._unsaved = 0
+
 class RealDownloader(AbstractDownloader):
-    def __init__(self, getter, tid):
-        super().__init__(getter)
+    ATTEMPTS = 3
+    # seconds before the first retry, doubling after that
+    RETRY_DELAY = 2
+    # what a dropped connection or a truncated transfer looks like; scp
+    # failures we can't classify are retried too
+    RETRY_ERRORS = (SCPConnectionError, subprocess.CalledProcessError,
+                    EOFError, zlib.error, gzip.BadGzipFile)
+
+    def __init__(self, getter, tid, post_processor=None, profiler=None):
+        super().__init__(getter, post_processor)
+        self._profiler = profiler or profiling.NoOpProfiler()
 
         self._root_dir = os.path.join(os.getcwd(), "tour-{}-images".format(tid))
 
@@ -149,6 +816,9 @@ class RealDownloader(AbstractDownloader):
             LOG.info("WARNING: Directory {} already exists.".format(
                 self._root_dir))
 
+        self._index = DownloadIndex(os.path.join(self._root_dir,
+                                                 "download-index.json"))
+
     def get(self, remote, section_id, page_id):
         LOG.debug("Getting remote", remote)
 
@@ -156,6 +826,9 @@ class RealDownloader(AbstractDownloader):
                                "section-{}".format(section_id),
                                "page-{}".format(page_id))
         filename = os.path.basename(remote).strip("*")
+        # where the getters put the decompressed file
+        expected_path = os.path.join(
+            new_dir, filename[:-3] if filename.endswith(".gz") else filename)
 
         try:
             os.makedirs(new_dir)
@@ -163,46 +836,135 @@ class RealDownloader(AbstractDownloader):
             # dir already exists
             pass
 
+        if self._index.is_verified(remote, expected_path):
+            LOG.debug("Already have", remote, "at", expected_path)
+            return expected_path
+
+        other_copy = self._index.verified_copy(remote)
+        if other_copy is not None:
+            LOG.debug("Reusing", remote, "from", other_copy)
+            self._place_copy(remote, other_copy, expected_path)
+            return expected_path
+
+        for attempt in range(1, self.ATTEMPTS + 1):
+            try:
+                return self._download(remote, new_dir, filename)
+            except self.RETRY_ERRORS as err:
+                LOG.info("Download of {} failed on attempt {}: {}".format(
+                    remote, attempt, err))
+            # e.g. a missing archive, which retrying won't fix
+            except (IOError, SCPError) as err:
+                LOG.info("Download of {} failed: {}".format(remote, err))
+                break
+
+            if attempt < self.ATTEMPTS:
+                time.sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+
+        LOG.error("Something went wrong trying to download the image",
+                  remote, ". Skipping.")
+
+        return None
+
+    def _place_copy(self, remote, source, dest):
+        '''
+        Put an already-verified copy of remote at dest, e.g. when another
+        page uses the same image.
+        '''
+        tmp_path = "{}.part".format(dest)
+
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+
+        os.replace(tmp_path, dest)
+        self._index.record_copy(remote, source, dest)
+
+    def _download(self, remote, new_dir, filename):
+        '''
+        Download and decompress into a staging directory, then move the
+        result into place only once it has decompressed cleanly (gzip checks
+        the length and CRC at the end of the stream).
+        '''
+        staging_dir = tempfile.mkdtemp(prefix=".download-", dir=new_dir)
+
         try:
-            new_gzipped, unzipped_name = self._getter.get(
-                remote, os.path.join(new_dir, filename))
+            start = time.perf_counter()
+            staged_path = self._getter.get_unzipped(
+                remote, os.path.join(staging_dir, filename))
+            unzipped_path = os.path.join(new_dir, os.path.basename(staged_path))
+
+            size = os.path.getsize(staged_path)
+            self._profiler.record_transfer(type(self._getter).__name__, size,
+                                           time.perf_counter() - start)
+            sha256 = _file_sha256(staged_path)
 
-            unzipped_path = os.path.join(new_dir, unzipped_name)
+            os.replace(staged_path, unzipped_path)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
-            with open(unzipped_path, "wb") as new_file:
-                new_file.write(new_gzipped.read())
+        self._index.record(remote, unzipped_path, size, sha256)
 
-            return unzipped_path
+        return unzipped_path
 
-        except (subprocess.CalledProcessError, IOError) as err:
-            LOG.error("Something went wrong trying to download the image",
-                      remote, ". Skipping.")
+    def finish(self):
+        self._index.save()
+        super().finish()
 
-            return None
+    def close(self):
+        self._index.save()
+        super().close()
 
 class Database:
     HOST = "wit.uchicago.edu"
     DATA_DB = "docent"
     MEDIA_DB = "docent_media"
 
+    # ids of every page in a tour, for use in "WHERE ... IN (...)"
+    TOUR_PAGES_FMT = "SELECT s.n_section_page_id FROM t_section_page s "\
+                     "INNER JOIN t_tour_section x ON s.n_tour_section_id = "\
+                     "x.n_tour_section_id WHERE n_tour_id = {tour_id}"
+
     def __init__(self, username=config.DB_USERNAME,
-                 password=config.DB_PASSWORD):
+                 password=config.DB_PASSWORD, throttle=None):
 
         self._username = username
         self._password = password
+        self._throttle = throttle or NoOpThrottle(self.HOST)
+
+        # connections are opened on first use, so that runs which never
+        # query (--help, replays, fully cached tours) don't pay for them
+        self._data_cx = None
+        self._media_cx = None
+
+    def _connect(self, database):
+        from mysql import connector
 
-        self._data_cx = connector.connect(user=username,
-                                          password=password,
-                                          host=self.HOST,
-                                          database=self.DATA_DB)
+        return connector.connect(user=self._username,
+                                 password=self._password,
+                                 host=self.HOST,
+                                 database=database)
 
-        self._media_cx = connector.connect(user=username,
-                                           password=password,
-                                           host=self.HOST,
-                                           database=self.MEDIA_DB)
+    @property
+    def _dcur(self):
+        if self._data_cx is None:
+            self._data_cx = self._connect(self.DATA_DB)
+            self._data_cur = self._data_cx.cursor()
 
-        self._dcur = self._data_cx.cursor()
-        self._mcur = self._media_cx.cursor()
+        return self._data_cur
+
+    @property
+    def _mcur(self):
+        if self._media_cx is None:
+            self._media_cx = self._connect(self.MEDIA_DB)
+            self._media_cur = self._media_cx.cursor()
+
+        return self._media_cur
 
     def _execute(self, cursor, query_string, **kwargs):
         '''
@@ -210,8 +972,9 @@ class Database:
         '''
         query = query_string.format(**kwargs)
         #LOG.debug("Sending query to database: ", query)
-        cursor.execute(query)
-        res = cursor.fetchall()
+        with self._throttle.track():
+            cursor.execute(query)
+            res = cursor.fetchall()
         #LOG.debug("Got results: ", res)
         return res
 
@@ -360,6 +1123,69 @@ class Database:
                                               tour_id=tour_id,
                                               page_id=page_id)]
 
+    def tour_to_questions(self, tour_id):
+        '''
+        Get (page id, question) pairs for every journal question in the
+        tour, in page and question order.
+        '''
+        QUERY_FMT = "SELECT n_section_page_id, t_body FROM t_page_quiz p "\
+                    "INNER JOIN t_quiz_question qq ON p.n_page_quiz_id = "\
+                    "qq.n_page_quiz_id INNER JOIN t_ques_body q ON "\
+                    "qq.n_quiz_ques_id = q.n_quiz_ques_id INNER JOIN t_body "\
+                    "b ON q.n_body_id = b.n_body_id WHERE n_section_page_id IN "\
+                    "({tour_pages}) ORDER BY n_section_page_id, n_sequence"
+
+        return self._dex(QUERY_FMT, tour_pages=self.TOUR_PAGES_FMT.format(
+            tour_id=tour_id))
+
+    def tour_to_words(self, tour_id):
+        '''
+        Get (page id, word) pairs for every dictionary word in the tour.
+        '''
+        QUERY_FMT = "SELECT DISTINCT n_section_page_id, s_word FROM "\
+                    "t_page_term p INNER JOIN t_word w ON p.n_word_id = "\
+                    "w.n_word_id INNER JOIN t_tour_term t ON p.n_tour_term_id "\
+                    "= t.n_tour_term_id WHERE n_tour_id = {tour_id} "\
+                    "ORDER BY n_section_page_id, s_word"
+
+        return self._dex(QUERY_FMT, tour_id=tour_id)
+
+    def tour_to_body_hashes(self, tour_id):
+        '''
+        Get (page id, MD5 of body text) pairs for every page in the tour.
+        The hashing happens on the server, so the bodies aren't sent.
+        '''
+        QUERY_FMT = "SELECT n_section_page_id, MD5(s_text) FROM t_text t "\
+                    "INNER JOIN t_page_text p ON t.n_text_id = p.n_text_id "\
+                    "WHERE n_section_page_id IN ({tour_pages})"
+
+        return self._dex(QUERY_FMT, tour_pages=self.TOUR_PAGES_FMT.format(
+            tour_id=tour_id))
+
+    def tour_to_media_ids(self, tour_id):
+        '''
+        Get (page id, media id) pairs for every page in the tour.
+        '''
+        QUERY_FMT = "SELECT n_section_page_id, n_media_id FROM t_page_media "\
+                    "WHERE s_mode IS NULL AND n_section_page_id IN "\
+                    "({tour_pages})"
+
+        return self._dex(QUERY_FMT, tour_pages=self.TOUR_PAGES_FMT.format(
+            tour_id=tour_id))
+
+    def tour_to_note_stamps(self, tour_id):
+        '''
+        Get (page id, latest note timestamp, note count) for every page in
+        the tour that has notes.
+        '''
+        QUERY_FMT = "SELECT n_section_page_id, MAX(t_timestamp), COUNT(*) "\
+                    "FROM t_notes n INNER JOIN t_page_notes p ON n.n_notes_id "\
+                    "= p.n_notes_id WHERE n_section_page_id IN ({tour_pages}) "\
+                    "GROUP BY n_section_page_id"
+
+        return self._dex(QUERY_FMT, tour_pages=self.TOUR_PAGES_FMT.format(
+            tour_id=tour_id))
+
     def page_to_notes(self, page_id):
         '''
         Get a list of Note objects for each note on the page.
@@ -389,6 +1215,161 @@ class Database:
         return ret
 
 
+def _encode_column(value):
+    '''
+    json.dumps default for the column types MySQL hands back that JSON
+    has no type for.
+    '''
+    import datetime
+    import decimal
+
+    # datetime first: it's a subclass of date
+    if isinstance(value, datetime.datetime):
+        return {"__type__": "datetime", "value": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"__type__": "date", "value": value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {"__type__": "timedelta", "value": value.total_seconds()}
+    if isinstance(value, decimal.Decimal):
+        return {"__type__": "decimal", "value": str(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {"__type__": "bytes", "value": bytes(value).hex()}
+
+    raise TypeError("Can't store {!r} in a snapshot".format(value))
+
+def _decode_column(obj):
+    '''
+    json.loads object_hook undoing _encode_column.
+    '''
+    import datetime
+    import decimal
+
+    decoders = {"datetime": datetime.datetime.fromisoformat,
+                "date": datetime.date.fromisoformat,
+                "timedelta": lambda value: datetime.timedelta(seconds=value),
+                "decimal": decimal.Decimal,
+                "bytes": bytes.fromhex}
+
+    if "__type__" not in obj:
+        return obj
+
+    return decoders[obj["__type__"]](obj["value"])
+
+class Snapshot:
+    '''
+    Single-file SQLite store of every query result (and media log file)
+    behind a tour, so that later runs can be replayed offline. Results are
+    stored as compressed JSON, keyed by database and query text, so that
+    loading someone else's snapshot can't run code the way a pickle could.
+    '''
+
+    def __init__(self, path, replaying=False):
+        import sqlite3
+
+        self.replaying = replaying
+
+        if replaying:
+            if not os.path.exists(path):
+                raise SnapshotError("No snapshot at {}".format(path))
+            self._cx = sqlite3.connect("file:{}?mode=ro".format(path),
+                                       uri=True)
+        else:
+            self._cx = sqlite3.connect(path)
+            self._cx.execute("CREATE TABLE IF NOT EXISTS results "
+                             "(db TEXT, query TEXT, result BLOB, "
+                             "PRIMARY KEY (db, query))")
+            self._cx.execute("CREATE TABLE IF NOT EXISTS logfiles "
+                             "(url TEXT PRIMARY KEY, text TEXT)")
+
+    def _get(self, query, *args):
+        row = self._cx.execute(query, args).fetchone()
+
+        if row is None:
+            raise SnapshotError("Not in snapshot: {}".format(args))
+
+        return row[0]
+
+    def put_rows(self, db, query, rows):
+        try:
+            result = json.dumps(rows, default=_encode_column)
+        except TypeError as err:
+            raise SnapshotError("Can't snapshot {}: {}".format(query, err))
+
+        self._cx.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                         (db, query, zlib.compress(result.encode("utf-8"))))
+
+    def get_rows(self, db, query):
+        result = self._get("SELECT result FROM results WHERE db = ? AND "
+                           "query = ?", db, query)
+
+        try:
+            rows = json.loads(zlib.decompress(result).decode("utf-8"),
+                              object_hook=_decode_column)
+        # e.g. a pickled result from an older snapshot
+        except (zlib.error, ValueError, KeyError) as err:
+            raise SnapshotError("Unreadable result for {}: {}".format(
+                query, err))
+
+        # rows come back from the connector as tuples
+        return [tuple(row) for row in rows]
+
+    def put_logfile(self, url, text):
+        self._cx.execute("INSERT OR REPLACE INTO logfiles VALUES (?, ?)",
+                         (url, text))
+
+    def get_logfile(self, url):
+        return self._get("SELECT text FROM logfiles WHERE url = ?", url)
+
+    def start_replaying(self):
+        '''
+        Switch a finished export over to serving reads.
+        '''
+        self._cx.commit()
+        self.replaying = True
+
+    def close(self):
+        self._cx.commit()
+        self._cx.close()
+
+class RecordingDatabase(Database):
+    '''
+    A live Database that also saves everything it returns to a Snapshot.
+    '''
+
+    def __init__(self, snapshot, **kwargs):
+        super().__init__(**kwargs)
+        self._snapshot = snapshot
+
+    def _dex(self, query_string, **kwargs):
+        rows = super()._dex(query_string, **kwargs)
+        self._snapshot.put_rows(self.DATA_DB, query_string.format(**kwargs),
+                                rows)
+        return rows
+
+    def _mex(self, query_string, **kwargs):
+        rows = super()._mex(query_string, **kwargs)
+        self._snapshot.put_rows(self.MEDIA_DB, query_string.format(**kwargs),
+                                rows)
+        return rows
+
+class ReplayDatabase(Database):
+    '''
+    A Database served entirely from a Snapshot, without connecting to
+    anything.
+    '''
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def _dex(self, query_string, **kwargs):
+        return self._snapshot.get_rows(self.DATA_DB,
+                                       query_string.format(**kwargs))
+
+    def _mex(self, query_string, **kwargs):
+        return self._snapshot.get_rows(self.MEDIA_DB,
+                                       query_string.format(**kwargs))
+
 class DBBuilder:
     def __init__(self, db):
         self._db = db
@@ -421,16 +1402,22 @@ class SectionBuilder(DBBuilder):
         return sections
 
 class MediaBuilder(DBBuilder):
-    LOGFILE_FMT = "http://new.web-docent.org/modules/media/{}/log.txt"
+    WEB_HOST = "new.web-docent.org"
+    LOGFILE_FMT = "http://" + WEB_HOST + "/modules/media/{}/log.txt"
     LOGFILE_REGEX = re.compile("^::Archive:(.*)$", re.MULTILINE)
 
     BASE_MEDIA_DIR = "/var/www/vhosts/cwd/modules/media/{}"
-    BASE_ARC_DIR = "/data/cmap/med_arc/*{}"
+    BASE_ARC_DIR = os.path.join(ArchiveIndex.ARC_DIR, "*{}")
     # Note that the base dir for archives in the log files does not exist
 
-    def __init__(self, db, downloader):
+    # statuses that mean the web host wants us to slow down
+    BACKOFF_STATUSES = (429, 503)
+
+    def __init__(self, db, downloader, throttle=None, snapshot=None):
         super().__init__(db)
         self._downloader = downloader
+        self._throttle = throttle or NoOpThrottle(self.WEB_HOST)
+        self._snapshot = snapshot
 
     def for_page(self, media_infos, section_id, page_id, infos_to_ids):
         media = []
@@ -466,7 +1453,7 @@ class MediaBuilder(DBBuilder):
                                               section_id,
                                               page_id)
             media_item.local_path = local_path
-
+            self._downloader.post_process(media_item)
 
         return media
 
@@ -509,9 +1496,24 @@ class MediaBuilder(DBBuilder):
         return media_item
 
 
+    def _fetch_logfile(self, url):
+        if self._snapshot is not None and self._snapshot.replaying:
+            return self._snapshot.get_logfile(url)
+
+        import requests
+
+        with self._throttle.track() as call:
+            resp = requests.get(url)
+            call.failed = resp.status_code in self.BACKOFF_STATUSES
+
+        if self._snapshot is not None:
+            self._snapshot.put_logfile(url, resp.text)
+
+        return resp.text
+
     def _process_logfile(self, file_path):
-        logtext = requests.get(self.LOGFILE_FMT.format(
-            file_path.strip("/"))).text
+        logtext = self._fetch_logfile(self.LOGFILE_FMT.format(
+            file_path.strip("/")))
         arc_old = self.LOGFILE_REGEX.search(logtext).group(0)
         file_name = arc_old.split("med_arc")[1].strip("/")
 
@@ -538,50 +1540,230 @@ class MediaBuilder(DBBuilder):
 
         return image_dirs, arc_image_paths, other_media_paths
 
+class TourAggregate:
+    '''
+    All the dictionary words and journal questions in a tour, indexed by
+    page, plus a deduplicated tour-wide glossary and question bank.
+    '''
+
+    def __init__(self, word_rows, question_rows):
+        self._page_words = collections.defaultdict(list)
+        self._page_questions = collections.defaultdict(list)
+
+        for page_id, word in word_rows:
+            self._page_words[page_id].append(word)
+
+        for page_id, question in question_rows:
+            self._page_questions[page_id].append(question)
+
+        self.glossary = sorted({word for _, word in word_rows},
+                               key=lambda word: (word.lower(), word))
+        # dedupe, keeping the order questions first appear in the tour
+        self.question_bank = list(dict.fromkeys(
+            question for _, question in question_rows))
+
+    def words_for(self, page_id):
+        return list(self._page_words.get(page_id, []))
+
+    def questions_for(self, page_id):
+        return list(self._page_questions.get(page_id, []))
+
+class TourAggregateBuilder(DBBuilder):
+    def for_tour(self, tour_id):
+        return TourAggregate(self._db.tour_to_words(tour_id),
+                             self._db.tour_to_questions(tour_id))
+
+class FingerprintBuilder(DBBuilder):
+    '''
+    Builds a cheap fingerprint for every page in a tour (body hash, media
+    ids and latest note), using three queries for the whole tour.
+    '''
+
+    def for_tour(self, tour_id):
+        body_hashes = dict(self._db.tour_to_body_hashes(tour_id))
+        note_stamps = {page_id: (latest, count) for page_id, latest, count
+                       in self._db.tour_to_note_stamps(tour_id)}
+
+        media_ids = collections.defaultdict(set)
+        for page_id, media_id in self._db.tour_to_media_ids(tour_id):
+            media_ids[page_id].add(media_id)
+
+        page_ids = body_hashes.keys() | media_ids.keys() | note_stamps.keys()
+
+        return {page_id: (body_hashes.get(page_id),
+                          tuple(sorted(media_ids[page_id])),
+                          note_stamps.get(page_id, (None, 0)))
+                for page_id in page_ids}
+
+class PageCache:
+    '''
+    Pages from a previous run, stored alongside the fingerprint they were
+    built from, so that a re-scrape only rebuilds the pages that changed.
+
+    The cache remembers the download mode and post-processing flag it was
+    built with, and is thrown away if they don't match this run's, since
+    the cached media would be wrong (e.g. never downloaded).
+    '''
+
+    def __init__(self, path, download_mode="no", postprocess=False):
+        self._path = path
+        self._options = (download_mode, postprocess)
+        self.hits = 0
+        self.misses = 0
+        self._pages = {}
+
+        try:
+            with open(path, "rb") as f:
+                stored = pickle.load(f)
+            options, pages = stored["options"], stored["pages"]
+        # a stale or moved Page/Media class fails with Attribute/ImportError
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError, KeyError, TypeError):
+            LOG.info("No usable page cache at {}, building every page.".format(
+                path))
+            return
+
+        if options != self._options:
+            LOG.info("Page cache at {} was built with {}, not {}; building "
+                     "every page.".format(path, options, self._options))
+            return
+
+        self._pages = pages
+
+    def _media_intact(self, page):
+        '''
+        Check that every image on page was downloaded (if this run downloads)
+        and is still on disk.
+        '''
+        downloading = self._options[0] != "no"
+
+        for media_item in page.media:
+            if media_item.media_type != "image":
+                continue
+            if media_item.local_path is None:
+                if downloading:
+                    return False
+            elif not os.path.exists(media_item.local_path):
+                return False
+
+        return True
+
+    def get(self, page_id, fingerprint):
+        '''
+        Get the cached page if its fingerprint still matches and its media
+        are intact, else None.
+        '''
+        cached = self._pages.get(page_id)
+
+        if fingerprint is not None and cached is not None and \
+           cached[0] == fingerprint and self._media_intact(cached[1]):
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        return None
+
+    def put(self, page_id, fingerprint, page):
+        if fingerprint is not None:
+            self._pages[page_id] = (fingerprint, page)
+
+    def save(self):
+        tmp_path = "{}.tmp".format(self._path)
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"options": self._options, "pages": self._pages}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path)
+
 class PageBuilder(DBBuilder):
 
-    def __init__(self, db, media_builder):
+    def __init__(self, db, media_builder, aggregate_builder=None,
+                 page_cache=None, fingerprint_builder=None, before_page=None):
         super().__init__(db)
+        self._before_page = before_page
         self._media_builder = media_builder
+        self._aggregate_builder = aggregate_builder or TourAggregateBuilder(db)
+        self._aggregates = {}
+        self._page_cache = page_cache
+        self._fingerprint_builder = fingerprint_builder or \
+                                    FingerprintBuilder(db)
+        self._fingerprints = {}
+
+    def aggregate_for(self, tour_id):
+        '''
+        Get the TourAggregate for a tour, querying for it the first time.
+        '''
+        if tour_id not in self._aggregates:
+            self._aggregates[tour_id] = self._aggregate_builder.for_tour(tour_id)
+
+        return self._aggregates[tour_id]
+
+    def _fingerprints_for(self, tour_id):
+        if tour_id not in self._fingerprints:
+            self._fingerprints[tour_id] = \
+                self._fingerprint_builder.for_tour(tour_id)
+
+        return self._fingerprints[tour_id]
 
     def for_section(self, tour_id, section_index):
         pages = []
 
         for page_id in self._db.section_to_pages(tour_id, section_index):
-            page = Page()
-            page.page_id = page_id
-            page.body = self._db.page_to_body_text(page_id)
+            if self._before_page is not None:
+                self._before_page()
+
+            if self._page_cache is None:
+                pages.append(self._build_page(tour_id, section_index, page_id))
+                continue
 
-            media_infos_and_ids = self._db.page_to_media_info(page_id)
-            media_infos_and_ids and LOG.debug("Got media_infos_and_ids:", media_infos_and_ids)
+            fingerprint = self._fingerprints_for(tour_id).get(page_id)
+            page = self._page_cache.get(page_id, fingerprint)
 
-            media_infos_to_ids = {"".join(infos): page_id for
-                                  infos, page_id in media_infos_and_ids}
+            if page is None:
+                page = self._build_page(tour_id, section_index, page_id)
+                self._page_cache.put(page_id, fingerprint, page)
+            else:
+                LOG.debug("Reusing unchanged page", page_id)
 
-            media_infos_to_ids and LOG.debug("Got media_infos_to_ids:", media_infos_to_ids)
+            pages.append(page)
 
-            file_infos = [x[0] for x in media_infos_and_ids]
-            # image_dir, arc_image_dir, \
-            #     other_media = self._process_media(media_infos or [])
-            page.media = self._media_builder.for_page(file_infos,
-                                                      section_index,
-                                                      page_id,
-                                                      media_infos_to_ids)
+        return pages
 
+    def _build_page(self, tour_id, section_index, page_id):
+        aggregate = self.aggregate_for(tour_id)
 
+        page = Page()
+        page.page_id = page_id
+        page.body = self._db.page_to_body_text(page_id)
 
-            # page.image_dirs = image_dir
-            # page.arc_image_paths = arc_image_dir
-            # page.other_media_paths = other_media
+        media_infos_and_ids = self._db.page_to_media_info(page_id)
+        media_infos_and_ids and LOG.debug("Got media_infos_and_ids:", media_infos_and_ids)
 
-            page.questions = self._db.page_to_questions(tour_id, page_id)
+        media_infos_to_ids = {"".join(infos): page_id for
+                              infos, page_id in media_infos_and_ids}
 
-            page.dictionary_words = self._db.page_to_words(tour_id, page_id)
+        media_infos_to_ids and LOG.debug("Got media_infos_to_ids:", media_infos_to_ids)
 
-            page.notes = self._db.page_to_notes(page_id)
+        file_infos = [x[0] for x in media_infos_and_ids]
+        # image_dir, arc_image_dir, \
+        #     other_media = self._process_media(media_infos or [])
+        page.media = self._media_builder.for_page(file_infos,
+                                                  section_index,
+                                                  page_id,
+                                                  media_infos_to_ids)
 
-            pages.append(page)
-        return pages
+
+
+        # page.image_dirs = image_dir
+        # page.arc_image_paths = arc_image_dir
+        # page.other_media_paths = other_media
+
+        page.questions = aggregate.questions_for(page_id)
+
+        page.dictionary_words = aggregate.words_for(page_id)
+
+        page.notes = self._db.page_to_notes(page_id)
+
+        return page
 
 
 class Section(PrintableMixin):
@@ -610,6 +1792,8 @@ class Media:
         self.media_type = None
         self.title = None
         self.caption = None
+        self.checksum = None
+        self.derivatives = {}
 
 class Printer:
     SEP = "-" * 25
@@ -631,6 +1815,8 @@ class Printer:
             to_print))
 
     def _fix_unicode(self, to_fix):
+        import ftfy
+
         bar_fixed = to_fix.replace("|", "'")
         return ftfy.fix_text(bar_fixed)
 
@@ -740,45 +1926,114 @@ class Printer:
         else:
             raise BadArgumentsError
 
+    def write_aggregate(self, aggregate, out_path):
+        '''
+        Write a tour's glossary and question bank, one entry per line.
+        '''
+        lines = ["GLOSSARY"] + aggregate.glossary + \
+                ["", "QUESTION BANK"] + aggregate.question_bank
 
-# @easylogger.log_at(new_level=logging.ERROR)
-def main():
-    arg_parser = argparse.ArgumentParser(description="Download web docent content.")
-    arg_parser.add_argument(
-        "-i", "--imagefiles",
-        dest="imagefiles",
-        action="store",
-        default="no",
-        help="specify download behavior (Yes, No, or Local. Default: do not download)")
-    arg_parser.add_argument(
-        "tour_id",
-        metavar="tour id",
-        nargs=1,
-        help="tour id to process",)
+        with open(out_path, "w") as f:
+            f.write("\n".join(self._fix_unicode(line) for line in lines))
+            f.write("\n")
 
-    args = arg_parser.parse_args()
 
-    LOG.debug("got args: ", args)
+def export_tour(db, web_throttle, snapshot, tour_id):
+    '''
+    Issue every Database query for the tour through db (a RecordingDatabase)
+    and fetch every media log file into snapshot, whatever this run's
+    options, so that the snapshot can serve a replay with any options.
+    '''
+    db.tour_to_tour_title(tour_id)
+    db.tour_to_module_title(tour_id)
+
+    FingerprintBuilder(db).for_tour(tour_id)
 
-    tour_id = args.tour_id[0]
+    # covers everything else a build asks for, downloads aside
+    media_builder = MediaBuilder(db, NoOpDownloader(), web_throttle, snapshot)
+    SectionBuilder(db, PageBuilder(db, media_builder)).for_tour(tour_id)
+
+def scrape_tour(tour_id, args, check_progress=None):
+    '''
+    Scrape one tour with the options in args, writing its summary,
+    glossary and question bank (and images, if asked for) into the current
+    directory. Returns the tour's
+    sections, or None if the tour has no content. check_progress, if
+    given, is called before each page and may raise to abandon the tour.
+    '''
+    profiler = profiling.Profiler() if args.profile else \
+               profiling.NoOpProfiler()
+    profiler.start()
 
+    try:
+        sections = _scrape_tour(tour_id, args, profiler, check_progress)
+    finally:
+        # always, so that a worker's next tour isn't profiled on top of this
+        profiler.stop()
+
+    if sections is not None:
+        profiler.write("resources-tour-{}.json".format(tour_id),
+                       "profile-tour-{}.pstats".format(tour_id))
+
+    return sections
+
+def _scrape_tour(tour_id, args, profiler, check_progress):
     def raise_error():
         raise BadArgumentsError
 
+    slots = SharedSlots(args.throttle_state) if args.throttle_state else None
+    db_throttle = Throttle(Database.HOST, args.db_rate, slots)
+    # log files and SCP transfers both come off the web host
+    web_throttle = Throttle(MediaBuilder.WEB_HOST, args.web_rate, slots)
+
+    post_processor = PostProcessor() if args.postprocess else None
+    arc_index = ArchiveIndex(args.arc_index) if args.arc_index else None
+
     downloader = collections.defaultdict(raise_error, {
-        "yes": lambda: RealDownloader(SCPGetter(), tour_id),
-        "local": lambda: RealDownloader(LocalGetter(), tour_id),
+        "yes": lambda: RealDownloader(SCPGetter(arc_index=arc_index,
+                                                throttle=web_throttle),
+                                      tour_id, post_processor, profiler),
+        "local": lambda: RealDownloader(LocalGetter(args.link_mode, arc_index),
+                                         tour_id, post_processor, profiler),
         "no": lambda: NoOpDownloader()
     })[args.imagefiles.lower()]()
 
-    db = Database()
-    media_builder = MediaBuilder(db, downloader)
-    page_builder = PageBuilder(db, media_builder)
+    if args.replay:
+        snapshot = Snapshot(args.replay, replaying=True)
+    elif args.export_snapshot:
+        snapshot = Snapshot(args.export_snapshot)
+    else:
+        snapshot = None
+
+    # an export is built first, and then this run is served from it
+    db = ReplayDatabase(snapshot) if snapshot is not None else \
+         Database(throttle=db_throttle)
+
+    media_builder = MediaBuilder(db, downloader, web_throttle, snapshot)
+    page_cache = PageCache("page-cache-tour-{}.pickle".format(tour_id),
+                           args.imagefiles.lower(), args.postprocess) \
+                 if args.changed_only else None
+    page_builder = PageBuilder(db, media_builder, page_cache=page_cache,
+                               before_page=check_progress)
     section_builder = SectionBuilder(db, page_builder)
 
 
     try:
-        sections = section_builder.for_tour(tour_id)
+        if args.export_snapshot:
+            with profiler.stage("export"):
+                export_tour(RecordingDatabase(snapshot, throttle=db_throttle),
+                            web_throttle, snapshot, tour_id)
+            snapshot.start_replaying()
+
+        with profiler.stage("build"):
+            sections = section_builder.for_tour(tour_id)
+            aggregate = page_builder.aggregate_for(tour_id)
+        with profiler.stage("post-process"):
+            downloader.finish()
+        if page_cache is not None:
+            page_cache.save()
+            LOG.info("Reused {} unchanged pages, rebuilt {}.".format(
+                page_cache.hits, page_cache.misses))
         printer = Printer()
         tour_summary = "CONTENT FOR TOUR ID {}".format(tour_id)
         module_summary = "MODULE TITLE: {}".format(db.tour_to_module_title(tour_id))
@@ -786,13 +2041,192 @@ def main():
         summary_text = "\n".join([tour_summary, module_summary, title_summary])
     except IndexError:
         return
+    finally:
+        downloader.close()
+        for throttle in (db_throttle, web_throttle):
+            LOG.info("Throttle stats:", throttle.stats())
+        if snapshot is not None:
+            snapshot.close()
+
+    if check_progress is not None:
+        check_progress()
 
-    printer.print_summary(summary_text)
-    printer.print_sections(sections)
-    printer.write_body("summary-tour-{}.txt".format(tour_id))
+    with profiler.stage("print"):
+        printer.print_summary(summary_text)
+        printer.print_sections(sections)
+        printer.write_body("summary-tour-{}.txt".format(tour_id))
+        printer.write_aggregate(aggregate,
+                                "glossary-tour-{}.txt".format(tour_id))
 
 
     return sections
 
+def run_worker(queue, args):
+    '''
+    Claim tours from queue and scrape them until there's nothing left
+    that isn't either finished or leased to another live worker.
+    '''
+    import workqueue
+
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    while True:
+        tour_id = queue.claim(worker)
+
+        if tour_id is None:
+            if not queue.outstanding():
+                break
+            time.sleep(args.poll_interval)
+            continue
+
+        LOG.info("Worker {} claimed tour {}".format(worker, tour_id))
+
+        with queue.heartbeat(tour_id, worker) as lease:
+            try:
+                sections = scrape_tour(tour_id, args, lease.check)
+            except workqueue.LeaseLostError:
+                LOG.error("Lost the lease on tour", tour_id, "to another "
+                          "worker; abandoning it.")
+                continue
+            # anything can go wrong in a scrape; the queue decides on retries
+            except Exception as err: # pylint: disable=broad-except
+                LOG.error("Tour", tour_id, "failed:", traceback.format_exc())
+                held = queue.fail(tour_id, worker, repr(err))
+            else:
+                if sections is None:
+                    held = queue.fail(tour_id, worker, "no content for tour",
+                                      retry=False)
+                else:
+                    held = queue.complete(tour_id, worker)
+
+        if not held:
+            LOG.error("Lease on tour", tour_id, "expired before it finished; "
+                      "another worker may have scraped it too.")
+
+    LOG.info("Queue drained:", queue.counts())
+
+# @easylogger.log_at(new_level=logging.ERROR)
+def main():
+    arg_parser = argparse.ArgumentParser(description="Download web docent content.")
+    arg_parser.add_argument(
+        "-i", "--imagefiles",
+        dest="imagefiles",
+        action="store",
+        default="no",
+        help="specify download behavior (Yes, No, or Local. Default: do not download)")
+    arg_parser.add_argument(
+        "-p", "--postprocess",
+        dest="postprocess",
+        action="store_true",
+        help="checksum downloaded images and build web formats and thumbnails in a process pool")
+    arg_parser.add_argument(
+        "--link-mode",
+        dest="link_mode",
+        choices=LocalGetter.LINK_MODES,
+        default="copy",
+        help="in local mode, how to place archive files that are already uncompressed (default: copy)")
+    arg_parser.add_argument(
+        "--arc-index",
+        dest="arc_index",
+        action="store",
+        default=None,
+        help="path to a persistent index of the med_arc directory, used instead of globbing it for every image")
+    arg_parser.add_argument(
+        "-c", "--changed-only",
+        dest="changed_only",
+        action="store_true",
+        help="only rebuild pages that changed since the last run with -c, reusing the rest from page-cache-tour-<id>.pickle")
+    arg_parser.add_argument(
+        "--db-rate",
+        dest="db_rate",
+        type=float,
+        default=None,
+        help="maximum queries per second against the database host, shared by every process using the same --throttle-state (default: unlimited)")
+    arg_parser.add_argument(
+        "--web-rate",
+        dest="web_rate",
+        type=float,
+        default=None,
+        help="maximum requests per second against the web host, for log files and SCP together, shared by every process using the same --throttle-state (default: unlimited)")
+    arg_parser.add_argument(
+        "--throttle-state",
+        dest="throttle_state",
+        action="store",
+        default=None,
+        help="SQLite file through which processes share their --db-rate/--web-rate budget (default: the queue file with --worker, otherwise each process gets the full rate)")
+    arg_parser.add_argument(
+        "--export-snapshot",
+        dest="export_snapshot",
+        action="store",
+        default=None,
+        help="save every database result and media log file for the tour to this SQLite file, then build from it")
+    arg_parser.add_argument(
+        "--replay",
+        dest="replay",
+        action="store",
+        default=None,
+        help="run offline against a snapshot saved with --export-snapshot")
+    arg_parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="write resources-tour-<id>.json (time, memory and download throughput per stage) and profile-tour-<id>.pstats; compare reports with profiling.py")
+    arg_parser.add_argument(
+        "--enqueue",
+        dest="enqueue",
+        action="store",
+        default=None,
+        help="add the given tour ids to this shared work queue and exit")
+    arg_parser.add_argument(
+        "--worker",
+        dest="worker",
+        action="store",
+        default=None,
+        help="scrape tours from this shared work queue until it is drained")
+    arg_parser.add_argument(
+        "--lease",
+        dest="lease",
+        type=float,
+        default=None,
+        help="seconds a worker's claim on a tour lasts without a heartbeat (default: 1800)")
+    arg_parser.add_argument(
+        "--poll-interval",
+        dest="poll_interval",
+        type=float,
+        default=30,
+        help="seconds a worker waits before checking the queue again (default: %(default)s)")
+    arg_parser.add_argument(
+        "tour_id",
+        metavar="tour id",
+        nargs="*",
+        help="tour id to process (several may be given with --enqueue)",)
+
+    args = arg_parser.parse_args()
+
+    easylogger.configure()
+
+    LOG.debug("got args: ", args)
+
+    if args.enqueue or args.worker:
+        # only queue users need sqlite
+        import workqueue
+
+    if args.enqueue:
+        queue = workqueue.WorkQueue(args.enqueue, args.lease)
+        queue.put(args.tour_id)
+        LOG.info("Queue now holds:", queue.counts())
+        return None
+
+    if args.worker:
+        # all workers share the queue file, so they share rates through it too
+        args.throttle_state = args.throttle_state or args.worker
+        run_worker(workqueue.WorkQueue(args.worker, args.lease), args)
+        return None
+
+    if len(args.tour_id) != 1:
+        arg_parser.error("expected exactly one tour id")
+
+    return scrape_tour(args.tour_id[0], args)
+
 if __name__ == '__main__':
     final_res = main()
@@ -0,0 +1,15 @@
+import os
+import sys
+import types
+
+# the scraper modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# scraper reads credentials from a local, uncommitted config.py; the tests
+# never connect to anything, so placeholders will do
+try:
+    import config  # pylint: disable=unused-import
+except ImportError:
+    sys.modules["config"] = types.SimpleNamespace(
+        DB_USERNAME="", DB_PASSWORD="", SCP_USERNAME="", SCP_PASSWORD="",
+        SCP_COMMAND="")
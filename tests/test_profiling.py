@@ -0,0 +1,69 @@
+import profiling
+
+
+def report(**fields):
+    fields.setdefault("stages", {})
+    fields.setdefault("transfers", {})
+    return fields
+
+
+def test_no_regressions_within_tolerance():
+    old = report(wall_seconds=10.0, cpu_seconds=5.0)
+    new = report(wall_seconds=11.0, cpu_seconds=4.0)
+
+    assert profiling.compare(old, new, tolerance=0.2) == []
+
+
+def test_run_cost_regression():
+    old = report(wall_seconds=10.0)
+    new = report(wall_seconds=13.0)
+
+    assert profiling.compare(old, new, tolerance=0.2) == \
+        ["wall_seconds: 10.000 -> 13.000"]
+
+
+def test_stage_regressions_only_for_stages_in_both():
+    old = report(stages={"build": {"python_peak_mb": 100.0},
+                         "print": {"wall_seconds": 1.0}})
+    new = report(stages={"build": {"python_peak_mb": 150.0}})
+
+    assert profiling.compare(old, new) == ["build python_peak_mb: 100.000 -> 150.000"]
+
+
+def test_throughput_regression_is_a_drop():
+    old = report(transfers={"LocalGetter": {"mb_per_second": 100.0},
+                            "SCPGetter": {"mb_per_second": 10.0}})
+    new = report(transfers={"LocalGetter": {"mb_per_second": 50.0},
+                            "SCPGetter": {"mb_per_second": 20.0}})
+
+    assert profiling.compare(old, new) == \
+        ["LocalGetter mb_per_second: 100.000 -> 50.000"]
+
+
+def test_missing_or_zero_baselines_are_skipped():
+    old = report(wall_seconds=0.0, max_rss_growth_mb=0.0,
+                 transfers={"LocalGetter": {"mb_per_second": None}})
+    new = report(wall_seconds=5.0, max_rss_growth_mb=300.0, cpu_seconds=9.0,
+                 transfers={"LocalGetter": {"mb_per_second": 10.0}})
+
+    assert profiling.compare(old, new) == []
+
+
+def test_profiler_report_has_compared_fields():
+    profiler = profiling.Profiler()
+    profiler.start()
+    try:
+        with profiler.stage("build"):
+            sum(range(1000))
+        profiler.record_transfer("LocalGetter", 2 * profiling.MB, 0.5)
+    finally:
+        profiler.stop()
+
+    result = profiler.report()
+
+    for field in profiling.RUN_COSTS:
+        assert field in result
+    for field in profiling.STAGE_COSTS:
+        assert field in result["stages"]["build"]
+    assert result["transfers"]["LocalGetter"]["mb_per_second"] == 4.0
+    assert profiling.compare(result, result) == []
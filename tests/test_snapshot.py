@@ -0,0 +1,49 @@
+import datetime
+import decimal
+import pickle
+import zlib
+
+import pytest
+
+from scraper import Snapshot, SnapshotError
+
+
+ROWS = [(1, "Tapirs", datetime.datetime(2009, 3, 4, 12, 30),
+         datetime.date(2009, 3, 4), decimal.Decimal("1.50"), None,
+         b"\x00\xff", datetime.timedelta(minutes=5))]
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    snapshot = Snapshot(str(tmp_path / "snapshot.db"))
+    yield snapshot
+    snapshot.close()
+
+
+def test_rows_round_trip(snapshot):
+    snapshot.put_rows("docent", "SELECT 1", ROWS)
+    snapshot.start_replaying()
+
+    assert snapshot.get_rows("docent", "SELECT 1") == ROWS
+
+
+def test_missing_query(snapshot):
+    snapshot.start_replaying()
+
+    with pytest.raises(SnapshotError):
+        snapshot.get_rows("docent", "SELECT 1")
+
+
+def test_unknown_column_type(snapshot):
+    with pytest.raises(SnapshotError):
+        snapshot.put_rows("docent", "SELECT 1", [(object(),)])
+
+
+def test_pickled_results_are_not_loaded(snapshot):
+    snapshot._cx.execute("INSERT INTO results VALUES (?, ?, ?)",
+                         ("docent", "SELECT 1",
+                          zlib.compress(pickle.dumps(ROWS))))
+    snapshot.start_replaying()
+
+    with pytest.raises(SnapshotError):
+        snapshot.get_rows("docent", "SELECT 1")
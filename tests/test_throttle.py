@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+from scraper import LocalSlots, SharedSlots, Throttle
+
+
+def call(throttle, failed=False):
+    with throttle.track() as tracked:
+        tracked.failed = failed
+
+
+def test_failure_cuts_rate():
+    throttle = Throttle("host", max_rate=1000, cooldown=0)
+
+    call(throttle, failed=True)
+
+    stats = throttle.stats()
+    assert stats["rate"] == 500
+    assert stats["errors"] == 1
+    assert stats["backoffs"] == 1
+
+
+def test_exception_counts_as_failure():
+    throttle = Throttle("host", max_rate=1000, cooldown=0)
+
+    with pytest.raises(ValueError):
+        with throttle.track():
+            raise ValueError("connection reset")
+
+    assert throttle.stats()["rate"] == 500
+
+
+def test_backs_off_once_per_cooldown():
+    throttle = Throttle("host", max_rate=1000, cooldown=60)
+
+    call(throttle, failed=True)
+    call(throttle, failed=True)
+
+    stats = throttle.stats()
+    assert stats["rate"] == 500
+    assert stats["errors"] == 2
+    assert stats["backoffs"] == 1
+
+
+def test_rate_never_drops_below_min_rate():
+    throttle = Throttle("host", max_rate=1000, min_rate=300, cooldown=0)
+
+    for _ in range(3):
+        call(throttle, failed=True)
+
+    assert throttle.stats()["rate"] == 300
+
+
+def test_recovers_additively_up_to_max_rate():
+    throttle = Throttle("host", max_rate=1000, recovery=200, cooldown=0)
+
+    call(throttle, failed=True)
+    call(throttle)
+    assert throttle.stats()["rate"] == 700
+
+    for _ in range(5):
+        call(throttle)
+    assert throttle.stats()["rate"] == 1000
+
+
+def test_unlimited_only_observes():
+    throttle = Throttle("host", cooldown=0)
+
+    call(throttle)
+    call(throttle, failed=True)
+
+    stats = throttle.stats()
+    assert stats["rate"] is None
+    assert stats["requests"] == 2
+    assert stats["errors"] == 1
+    assert stats["backoffs"] == 0
+
+
+def test_latency_rise_cuts_rate():
+    throttle = Throttle("host", max_rate=1000, cooldown=0)
+
+    throttle._release(0.01, False)
+    throttle._release(1.0, False)
+
+    assert throttle.stats()["rate"] == 500
+
+
+def test_untimed_calls_only_adapt_on_errors():
+    throttle = Throttle("host", max_rate=1000, cooldown=0)
+
+    throttle._release(0.01, False)
+    with throttle.track(timed=False):
+        time.sleep(0.1)
+
+    stats = throttle.stats()
+    assert stats["rate"] == 1000
+    assert stats["latency"] == 0.01
+
+    call(throttle, failed=True)
+    assert throttle.stats()["rate"] == 500
+
+
+def test_local_slots_are_per_instance():
+    first, second = LocalSlots(), LocalSlots()
+
+    assert first.reserve("host", 10) == 0
+    assert second.reserve("host", 10) == 0
+    assert first.reserve("host", 10) == pytest.approx(10, abs=0.5)
+
+
+def test_shared_slots_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "throttle.db")
+    first, second = SharedSlots(path), SharedSlots(path)
+
+    assert first.reserve("host", 10) == 0
+    assert second.reserve("host", 10) == pytest.approx(10, abs=0.5)
+    assert second.reserve("other host", 10) == 0
+
+
+def test_stats_report_shared_slots(tmp_path):
+    shared = SharedSlots(str(tmp_path / "throttle.db"))
+
+    assert Throttle("host", slots=shared).stats()["shared"]
+    assert not Throttle("host").stats()["shared"]
@@ -0,0 +1,50 @@
+from scraper import TourAggregate
+
+
+WORDS = [(1, "tapir"), (1, "Okapi"), (2, "aardvark"), (2, "tapir"),
+         (3, "okapi")]
+QUESTIONS = [(1, "Why stripes?"), (2, "Where do tapirs live?"),
+             (3, "Why stripes?")]
+
+
+def test_per_page_lists_keep_query_order():
+    aggregate = TourAggregate(WORDS, QUESTIONS)
+
+    assert aggregate.words_for(1) == ["tapir", "Okapi"]
+    assert aggregate.words_for(2) == ["aardvark", "tapir"]
+    assert aggregate.questions_for(3) == ["Why stripes?"]
+
+
+def test_pages_without_rows_get_empty_lists():
+    aggregate = TourAggregate(WORDS, QUESTIONS)
+
+    assert aggregate.words_for(99) == []
+    assert aggregate.questions_for(99) == []
+
+
+def test_per_page_lists_are_copies():
+    aggregate = TourAggregate(WORDS, QUESTIONS)
+
+    aggregate.words_for(1).append("zebra")
+
+    assert aggregate.words_for(1) == ["tapir", "Okapi"]
+
+
+def test_glossary_is_deduplicated_and_sorted_ignoring_case():
+    aggregate = TourAggregate(WORDS, QUESTIONS)
+
+    assert aggregate.glossary == ["aardvark", "Okapi", "okapi", "tapir"]
+
+
+def test_question_bank_keeps_first_appearance_order():
+    aggregate = TourAggregate(WORDS, QUESTIONS)
+
+    assert aggregate.question_bank == ["Why stripes?",
+                                       "Where do tapirs live?"]
+
+
+def test_empty_tour():
+    aggregate = TourAggregate([], [])
+
+    assert aggregate.glossary == []
+    assert aggregate.question_bank == []
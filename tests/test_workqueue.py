@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+import workqueue
+from workqueue import CLAIMED, DONE, FAILED, PENDING, WorkQueue
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.db")
+
+
+def states(queue):
+    return dict(queue._cx.execute("SELECT unit, state FROM units").fetchall())
+
+
+def expire_leases(queue):
+    queue._cx.execute("UPDATE units SET lease_expires = 0")
+
+
+def test_claims_units_in_order_then_none(queue_path):
+    queue = WorkQueue(queue_path)
+    queue.put([1, 2])
+
+    assert queue.claim("a") == "1"
+    assert queue.claim("b") == "2"
+    assert queue.claim("c") is None
+    assert queue.counts() == {CLAIMED: 2}
+
+
+def test_put_ignores_units_already_queued(queue_path):
+    queue = WorkQueue(queue_path)
+    queue.put([1])
+    queue.claim("a")
+    queue.complete("1", "a")
+
+    queue.put([1, 2])
+
+    assert states(queue) == {"1": DONE, "2": PENDING}
+
+
+def test_expired_lease_goes_to_next_claimant(queue_path):
+    queue = WorkQueue(queue_path)
+    queue.put([1])
+    queue.claim("a")
+
+    expire_leases(queue)
+
+    assert queue.claim("b") == "1"
+
+
+def test_expired_lease_on_last_attempt_fails(queue_path):
+    queue = WorkQueue(queue_path, max_attempts=1)
+    queue.put([1])
+    queue.claim("a")
+
+    expire_leases(queue)
+
+    assert queue.claim("b") is None
+    assert states(queue) == {"1": FAILED}
+    assert not queue.outstanding()
+
+
+def test_fail_retries_until_max_attempts(queue_path):
+    queue = WorkQueue(queue_path, max_attempts=2)
+    queue.put([1])
+
+    queue.claim("a")
+    assert queue.fail("1", "a", "timeout")
+    assert states(queue) == {"1": PENDING}
+
+    assert queue.claim("b") == "1"
+    assert queue.fail("1", "b", "timeout")
+    assert states(queue) == {"1": FAILED}
+    assert queue.claim("c") is None
+
+
+def test_fail_without_retry(queue_path):
+    queue = WorkQueue(queue_path)
+    queue.put([1])
+    queue.claim("a")
+
+    assert queue.fail("1", "a", "no content", retry=False)
+    assert states(queue) == {"1": FAILED}
+
+
+def test_lost_lease_is_reported(queue_path):
+    queue = WorkQueue(queue_path)
+    queue.put([1])
+    queue.claim("a")
+    expire_leases(queue)
+    queue.claim("b")
+
+    assert not queue.renew("1", "a")
+    assert not queue.complete("1", "a")
+    assert not queue.fail("1", "a", "late")
+    assert queue.complete("1", "b")
+    assert states(queue) == {"1": DONE}
+
+
+def test_heartbeat_keeps_lease(queue_path):
+    queue = WorkQueue(queue_path, lease_seconds=0.3)
+    queue.put([1])
+    queue.claim("a")
+
+    with queue.heartbeat("1", "a") as lease:
+        time.sleep(0.5)
+        assert queue.claim("b") is None
+        lease.check()
+
+    assert queue.complete("1", "a")
+
+
+def test_heartbeat_notices_lost_lease(queue_path):
+    queue = WorkQueue(queue_path, lease_seconds=0.3)
+    queue.put([1])
+    queue.claim("a")
+    expire_leases(queue)
+    queue.claim("b")
+
+    with queue.heartbeat("1", "a") as lease:
+        time.sleep(0.4)
+
+    assert lease.lost
+    with pytest.raises(workqueue.LeaseLostError):
+        lease.check()
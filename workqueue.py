@@ -0,0 +1,198 @@
+"""
+Shared queue of scrape work units (tour ids), for spreading an archive
+run across several machines. Backed by a single SQLite file, which is
+fine on local disk or a well-behaved shared mount.
+
+Workers claim units with a time-limited lease and keep it alive with a
+heartbeat while they work. A unit whose lease runs out (because its
+worker crashed or lost the mount) goes back to whoever claims next, up
+to max_attempts times.
+"""
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+LOG = logging.getLogger(__name__)
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class Lease:
+    '''
+    A worker's hold on a unit, as kept up by WorkQueue.heartbeat().
+    '''
+
+    def __init__(self, unit):
+        self.unit = unit
+        self._lost = threading.Event()
+
+    @property
+    def lost(self):
+        return self._lost.is_set()
+
+    def check(self):
+        '''
+        Raise LeaseLostError if another worker has taken the unit over.
+        '''
+        if self.lost:
+            raise LeaseLostError("Lease on {} was lost".format(self.unit))
+
+
+class WorkQueue:
+    DEFAULT_LEASE = 30 * 60
+    # how long to wait on another node's write lock
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, path, lease_seconds=None, max_attempts=3):
+        self._path = path
+        self._lease_seconds = lease_seconds or self.DEFAULT_LEASE
+        self._max_attempts = max_attempts
+        self._cx = self._connect()
+
+        self._cx.execute("CREATE TABLE IF NOT EXISTS units "
+                         "(unit TEXT PRIMARY KEY, state TEXT, worker TEXT, "
+                         "lease_expires REAL, attempts INTEGER, error TEXT)")
+
+    def _connect(self):
+        # autocommit, so that we can take the write lock up front ourselves
+        return sqlite3.connect(self._path, timeout=self.LOCK_TIMEOUT,
+                               isolation_level=None)
+
+    def put(self, units):
+        '''
+        Add units to the queue. Units already in it are left alone.
+        '''
+        self._cx.execute("BEGIN IMMEDIATE")
+        self._cx.executemany(
+            "INSERT OR IGNORE INTO units VALUES (?, ?, NULL, NULL, 0, NULL)",
+            [(str(unit), PENDING) for unit in units])
+        self._cx.execute("COMMIT")
+
+    def claim(self, worker):
+        '''
+        Lease the next available unit to worker, or return None if nothing
+        is available right now.
+        '''
+        now = time.time()
+
+        self._cx.execute("BEGIN IMMEDIATE")
+        try:
+            # leases that ran out on their last allowed attempt
+            self._cx.execute("UPDATE units SET state = ?, error = ? WHERE "
+                             "state = ? AND lease_expires < ? AND attempts >= ?",
+                             (FAILED, "lease expired", CLAIMED, now,
+                              self._max_attempts))
+
+            row = self._cx.execute("SELECT unit FROM units WHERE state = ? OR "
+                                   "(state = ? AND lease_expires < ?) "
+                                   "ORDER BY rowid LIMIT 1",
+                                   (PENDING, CLAIMED, now)).fetchone()
+
+            if row is not None:
+                self._cx.execute("UPDATE units SET state = ?, worker = ?, "
+                                 "lease_expires = ?, attempts = attempts + 1 "
+                                 "WHERE unit = ?",
+                                 (CLAIMED, worker, now + self._lease_seconds,
+                                  row[0]))
+            self._cx.execute("COMMIT")
+        except sqlite3.Error:
+            self._cx.execute("ROLLBACK")
+            raise
+
+        return None if row is None else row[0]
+
+    def _renew(self, cx, unit, worker):
+        cursor = cx.execute("UPDATE units SET lease_expires = ? WHERE "
+                            "unit = ? AND worker = ? AND state = ?",
+                            (time.time() + self._lease_seconds, unit, worker,
+                             CLAIMED))
+        return cursor.rowcount == 1
+
+    def renew(self, unit, worker):
+        '''
+        Extend worker's lease on unit. Returns False if the lease has been
+        lost to another worker.
+        '''
+        return self._renew(self._cx, unit, worker)
+
+    @contextlib.contextmanager
+    def heartbeat(self, unit, worker):
+        '''
+        Keep worker's lease on unit alive for the duration of the block.
+        Yields a Lease, which notes if the lease is lost to another worker;
+        long-running work should call its check() regularly.
+        '''
+        stop = threading.Event()
+        lease = Lease(unit)
+
+        def beat():
+            # sqlite connections can't be shared across threads
+            cx = None
+            while not stop.wait(self._lease_seconds / 3):
+                try:
+                    if cx is None:
+                        cx = self._connect()
+                    if not self._renew(cx, unit, worker):
+                        lease._lost.set()
+                        break
+                # e.g. the file is locked or the mount hiccuped; the lease
+                # has time left, so try again on the next beat
+                except sqlite3.Error as err:
+                    LOG.warning("Couldn't renew lease on %s: %s", unit, err)
+            if cx is not None:
+                cx.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+
+        try:
+            yield lease
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, unit, worker):
+        '''
+        Mark unit done. Returns False if worker no longer held the lease.
+        '''
+        cursor = self._cx.execute("UPDATE units SET state = ?, error = NULL "
+                                  "WHERE unit = ? AND worker = ? AND state = ?",
+                                  (DONE, unit, worker, CLAIMED))
+        return cursor.rowcount == 1
+
+    def fail(self, unit, worker, error, retry=True):
+        '''
+        Give up worker's lease on unit, putting it back in the queue unless
+        it has used up its attempts (or retry is False). Returns False if
+        worker no longer held the lease.
+        '''
+        cursor = self._cx.execute(
+            "UPDATE units SET state = CASE WHEN ? AND attempts < ? THEN ? "
+            "ELSE ? END, error = ? WHERE unit = ? AND worker = ? AND state = ?",
+            (retry, self._max_attempts, PENDING, FAILED, error, unit, worker,
+             CLAIMED))
+        return cursor.rowcount == 1
+
+    def counts(self):
+        '''
+        Get the number of units in each state.
+        '''
+        return dict(self._cx.execute(
+            "SELECT state, COUNT(*) FROM units GROUP BY state").fetchall())
+
+    def outstanding(self):
+        '''
+        Get the number of units that aren't finished yet, including ones
+        currently leased to workers.
+        '''
+        counts = self.counts()
+        return counts.get(PENDING, 0) + counts.get(CLAIMED, 0)